@@ -1,15 +1,61 @@
 # app.py
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, session, g
+from flask.json.provider import DefaultJSONProvider
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
+import orjson
+from sqlalchemy import event, select, insert, delete, func
+from sqlalchemy.orm import selectinload, joinedload, raiseload, load_only
 from datetime import datetime, date, timedelta
+from types import MappingProxyType
+from collections.abc import Mapping
 from config import Config
-from models import db, User, Product, MealEntry, DailyGoal, Recipe, RecipeIngredient
+from models import (db, User, Product, MealEntry, DailyGoal, Recipe, RecipeIngredient,
+                    calculate_calories, aggregate_nutrition, nutrition_per_100g)
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson (used by request.get_json and |tojson; responses use json_response)"""
+
+    @staticmethod
+    def default(obj):
+        if isinstance(obj, Mapping):
+            return dict(obj)
+        return DefaultJSONProvider.default(obj)
+
+    def dumps(self, obj, **kwargs):
+        kwargs.pop('sort_keys', None)
+        # Остальные параметры stdlib (separators, indent) — например, у сериализатора сессии
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **kwargs):
+        # object_hook нужен сериализатору сессии; orjson его не поддерживает
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
 
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.config.from_object(Config)
 db.init_app(app)
 
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """WAL journal with relaxed fsync, larger page cache and mmap for each new SQLite connection"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA cache_size=-64000')
+    cursor.execute('PRAGMA mmap_size=268435456')
+    cursor.close()
+
+
+with app.app_context():
+    if db.engine.dialect.name == 'sqlite':
+        event.listen(db.engine, 'connect', set_sqlite_pragmas)
+
 # Flask-Login setup
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -22,29 +68,62 @@ app.jinja_env.globals['timedelta'] = timedelta
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return db.session.get(User, int(user_id))
+
+
+def list_options(*options):
+    """Loader options for list queries; RAISELOAD_DEBUG turns stray lazy loads into errors"""
+    if app.config.get('RAISELOAD_DEBUG'):
+        options += (raiseload('*'),)
+    return options
+
+
+def json_response(obj):
+    """JSON response encoded directly with orjson; the single JSON response path of the app"""
+    return app.response_class(orjson.dumps(obj, default=OrjsonProvider.default), mimetype='application/json')
+
+
+# Колонки продукта, нужные спискам и to_dict(); user_id и created_at не загружаются
+PRODUCT_LIST_COLUMNS = (Product.id, Product.name, Product.calories, Product.protein,
+                        Product.fat, Product.carbs, Product.is_recipe)
+
+# Ингредиенты рецептов со своими продуктами: два запроса на любой список рецептов
+RECIPE_INGREDIENTS_LOADER = (
+    selectinload(Recipe.ingredients)
+    .joinedload(RecipeIngredient.product, innerjoin=True)
+    .load_only(*PRODUCT_LIST_COLUMNS)
+)
 
 
-MEAL_TYPES = {
+MEAL_TYPES = MappingProxyType({
     'breakfast': 'Завтрак',
     'lunch': 'Обед',
     'dinner': 'Ужин',
     'snack': 'Перекус'
-}
+})
+
+app.jinja_env.globals['meal_types'] = MEAL_TYPES
 
 
 # =====================================================
 # MIDDLEWARE - проверка первоначальной настройки
 # =====================================================
 
+SETUP_ALLOWED_ENDPOINTS = frozenset({'setup', 'logout', 'static', 'api_sync_all'})
+
+
 @app.before_request
 def check_setup():
     """Redirect to setup if user hasn't completed initial setup"""
+    if not request.endpoint or request.endpoint in SETUP_ALLOWED_ENDPOINTS:
+        return
     if current_user.is_authenticated:
-        allowed_endpoints = ['setup', 'logout', 'static', 'api_sync_all']
-        if request.endpoint and request.endpoint not in allowed_endpoints:
-            if not current_user.is_setup_complete:
-                return redirect(url_for('setup'))
+        # Флаг кэшируется в сессии при входе; для старых сессий берём его у пользователя
+        setup_complete = session.get('setup_complete')
+        if setup_complete is None:
+            setup_complete = session['setup_complete'] = current_user.is_setup_complete
+        if not setup_complete:
+            return redirect(url_for('setup'))
 
 
 # =====================================================
@@ -67,10 +146,11 @@ def login():
             flash('Заполните все поля', 'error')
             return redirect(url_for('login'))
 
-        user = User.query.filter_by(username=username).first()
+        user = db.session.execute(select(User).where(User.username == username)).scalar_one_or_none()
 
         if user and user.check_password(password):
             login_user(user, remember=remember)
+            session['setup_complete'] = user.is_setup_complete
 
             if not user.is_setup_complete:
                 return redirect(url_for('setup'))
@@ -100,6 +180,7 @@ def delete_account():
             user = current_user
             # Выходим из аккаунта (очищаем сессию)
             logout_user()
+            session.pop('setup_complete', None)
             # Удаляем пользователя (через каскад удалятся продукты, записи, рецепты, цели)
             db.session.delete(user)
             db.session.commit()
@@ -140,7 +221,7 @@ def register():
             flash('Пароли не совпадают', 'error')
             return redirect(url_for('register'))
 
-        existing_user = User.query.filter_by(username=username).first()
+        existing_user = db.session.execute(select(User).where(User.username == username)).scalar_one_or_none()
         if existing_user:
             flash('Пользователь с таким логином уже существует', 'error')
             return redirect(url_for('register'))
@@ -151,6 +232,7 @@ def register():
         db.session.commit()
 
         login_user(user)
+        session['setup_complete'] = False
         return redirect(url_for('setup'))
 
     return render_template('auth/register.html')
@@ -161,11 +243,12 @@ def register():
 def setup():
     """Initial setup - set weight and daily goals"""
     if current_user.is_setup_complete:
+        session['setup_complete'] = True
         return redirect(url_for('index'))
 
     if request.method == 'POST':
         # Получаем вес
-        weight = float(request.form.get('weight', 70))
+        weight = form_float('weight', 70)
         activity = request.form.get('activity', 'moderate')
 
         # Сохраняем вес пользователя
@@ -180,12 +263,13 @@ def setup():
             fat = recommended['fat']
             carbs = recommended['carbs']
         else:
-            protein = float(request.form.get('protein', 50))
-            fat = float(request.form.get('fat', 65))
-            carbs = float(request.form.get('carbs', 300))
+            protein = form_float('protein', 50)
+            fat = form_float('fat', 65)
+            carbs = form_float('carbs', 300)
 
-        calories = DailyGoal.calculate_calories(protein, fat, carbs)
+        calories = calculate_calories(protein, fat, carbs)
 
+        # Без commit внутри: цели, продукты по умолчанию и флаг настройки сохраняются одной транзакцией
         goal = DailyGoal.query.filter_by(user_id=current_user.id).first()
         if not goal:
             goal = DailyGoal(user_id=current_user.id)
@@ -200,6 +284,7 @@ def setup():
 
         current_user.is_setup_complete = True
         db.session.commit()
+        session['setup_complete'] = True
 
         flash(f'Настройка завершена! Ваша норма: {int(calories)} ккал/день', 'success')
         return redirect(url_for('index'))
@@ -211,6 +296,7 @@ def setup():
 @login_required
 def logout():
     logout_user()
+    session.pop('setup_complete', None)
     flash('Вы вышли из системы', 'info')
     return redirect(url_for('login'))
 
@@ -223,31 +309,31 @@ def logout():
 @login_required
 def api_sync_all():
     if request.method == 'GET':
-        products = Product.query.filter_by(user_id=current_user.id).all()
-        recipes = Recipe.query.filter_by(user_id=current_user.id).all()
-        goals = DailyGoal.get_goals(current_user.id)
+        products = Product.query.options(*list_options(
+            load_only(*PRODUCT_LIST_COLUMNS)
+        )).filter_by(user_id=current_user.id).all()
+        recipes = Recipe.query.options(*list_options(RECIPE_INGREDIENTS_LOADER)).filter_by(
+            user_id=current_user.id).all()
+        goals = goals_for(current_user.id)
 
         start_date = date.today() - timedelta(days=30)
-        entries = MealEntry.query.filter(
+        entries = MealEntry.query.options(*list_options(
+            joinedload(MealEntry.product, innerjoin=True).load_only(*PRODUCT_LIST_COLUMNS)
+        )).filter(
             MealEntry.user_id == current_user.id,
             MealEntry.date >= start_date
         ).all()
 
-        return jsonify({
+        return json_response({
             'success': True,
             'timestamp': datetime.utcnow().isoformat(),
             'data': {
-                'user': {
-                    'id': current_user.id,
-                    'username': current_user.username,
-                    'weight': current_user.weight,
-                    'is_setup_complete': current_user.is_setup_complete
-                },
+                'user': current_user.to_dict(),
                 'products': [p.to_dict() for p in products],
                 'recipes': [r.to_dict() for r in recipes],
                 'goals': goals.to_dict(),
                 'entries': [e.to_dict() for e in entries],
-                'meal_types': MEAL_TYPES
+                'meal_types': dict(MEAL_TYPES)
             }
         })
 
@@ -259,50 +345,66 @@ def api_sync_all():
                 current_user.weight = float(data['user_weight'])
 
             new_entries = data.get('new_entries', [])
-            for entry_data in new_entries:
-                entry = MealEntry(
-                    user_id=current_user.id,
-                    product_id=entry_data['product_id'],
-                    meal_type=entry_data['meal_type'],
-                    weight=entry_data['weight'],
-                    date=datetime.strptime(entry_data['date'], '%Y-%m-%d').date()
-                )
-                db.session.add(entry)
+            if new_entries:
+                # Даты в пакете повторяются: разбираем каждую строку один раз
+                dates = {d: date.fromisoformat(d) for d in {entry_data['date'] for entry_data in new_entries}}
+                db.session.execute(insert(MealEntry), [
+                    {
+                        'user_id': current_user.id,
+                        'product_id': entry_data['product_id'],
+                        'meal_type': entry_data['meal_type'],
+                        'weight': entry_data['weight'],
+                        'date': dates[entry_data['date']]
+                    }
+                    for entry_data in new_entries
+                ])
 
             deleted_entries = data.get('deleted_entries', [])
-            for entry_id in deleted_entries:
-                entry = MealEntry.query.filter_by(id=entry_id, user_id=current_user.id).first()
-                if entry:
-                    db.session.delete(entry)
+            if deleted_entries:
+                db.session.execute(
+                    delete(MealEntry).where(
+                        MealEntry.user_id == current_user.id,
+                        MealEntry.id.in_(deleted_entries)
+                    ),
+                    execution_options={'synchronize_session': False}
+                )
 
             new_products = data.get('new_products', [])
             created_products = []
-            for prod_data in new_products:
-                product = Product(
-                    user_id=current_user.id,
-                    name=prod_data['name'],
-                    calories=prod_data['calories'],
-                    protein=prod_data['protein'],
-                    fat=prod_data['fat'],
-                    carbs=prod_data['carbs'],
-                    is_recipe=prod_data.get('is_recipe', False)
+            if new_products:
+                # Один INSERT ... RETURNING вместо flush() на каждый продукт
+                products = db.session.scalars(
+                    insert(Product).returning(Product, sort_by_parameter_order=True),
+                    [
+                        {
+                            'user_id': current_user.id,
+                            'name': prod_data['name'],
+                            'calories': prod_data['calories'],
+                            'protein': prod_data['protein'],
+                            'fat': prod_data['fat'],
+                            'carbs': prod_data['carbs'],
+                            'is_recipe': prod_data.get('is_recipe', False)
+                        }
+                        for prod_data in new_products
+                    ]
                 )
-                db.session.add(product)
-                db.session.flush()
-                created_products.append(product.to_dict())
+                created_products = [product.to_dict() for product in products]
 
             deleted_products = data.get('deleted_products', [])
-            for prod_id in deleted_products:
-                product = Product.query.filter_by(id=prod_id, user_id=current_user.id).first()
-                if product:
+            if deleted_products:
+                # Удаляем через ORM, чтобы сработали связи с рецептами и записями
+                for product in db.session.scalars(select(Product).where(
+                    Product.user_id == current_user.id,
+                    Product.id.in_(deleted_products)
+                )).all():
                     db.session.delete(product)
 
             if 'goals' in data:
-                goals = DailyGoal.get_goals(current_user.id)
+                goals = goals_for(current_user.id)
                 goals.protein = data['goals']['protein']
                 goals.fat = data['goals']['fat']
                 goals.carbs = data['goals']['carbs']
-                goals.calories = DailyGoal.calculate_calories(
+                goals.calories = calculate_calories(
                     data['goals']['protein'],
                     data['goals']['fat'],
                     data['goals']['carbs']
@@ -310,7 +412,7 @@ def api_sync_all():
 
             db.session.commit()
 
-            return jsonify({
+            return json_response({
                 'success': True,
                 'created_products': created_products,
                 'message': 'Синхронизация успешна'
@@ -318,7 +420,7 @@ def api_sync_all():
 
         except Exception as e:
             db.session.rollback()
-            return jsonify({'success': False, 'error': str(e)}), 500
+            return json_response({'success': False, 'error': str(e)}), 500
 
 
 @app.route('/api/add_entry', methods=['POST'])
@@ -326,38 +428,51 @@ def api_sync_all():
 def api_add_entry():
     try:
         data = request.get_json()
+        product = db.session.execute(select(Product).where(
+            Product.id == data['product_id'],
+            Product.user_id == current_user.id
+        )).scalar_one_or_none()
+        if not product:
+            return json_response({'success': False, 'error': 'Product not found'}), 404
+
         entry = MealEntry(
             user_id=current_user.id,
-            product_id=data['product_id'],
+            product=product,
             meal_type=data['meal_type'],
             weight=data['weight'],
-            date=datetime.strptime(data['date'], '%Y-%m-%d').date()
+            date=date.fromisoformat(data['date'])
         )
         db.session.add(entry)
+        db.session.flush()
+        # Ответ собирается до commit(), пока запись и продукт не истекли в сессии
+        entry_data = entry.to_dict()
         db.session.commit()
 
-        return jsonify({
+        return json_response({
             'success': True,
-            'entry': entry.to_dict()
+            'entry': entry_data
         })
     except Exception as e:
         db.session.rollback()
-        return jsonify({'success': False, 'error': str(e)}), 500
+        return json_response({'success': False, 'error': str(e)}), 500
 
 
 @app.route('/api/delete_entry/<int:entry_id>', methods=['DELETE'])
 @login_required
 def api_delete_entry(entry_id):
     try:
-        entry = MealEntry.query.filter_by(id=entry_id, user_id=current_user.id).first()
+        entry = db.session.execute(select(MealEntry).where(
+            MealEntry.id == entry_id,
+            MealEntry.user_id == current_user.id
+        )).scalar_one_or_none()
         if entry:
             db.session.delete(entry)
             db.session.commit()
-            return jsonify({'success': True})
-        return jsonify({'success': False, 'error': 'Not found'}), 404
+            return json_response({'success': True})
+        return json_response({'success': False, 'error': 'Not found'}), 404
     except Exception as e:
         db.session.rollback()
-        return jsonify({'success': False, 'error': str(e)}), 500
+        return json_response({'success': False, 'error': str(e)}), 500
 
 
 @app.route('/api/add_product', methods=['POST'])
@@ -369,7 +484,7 @@ def api_add_product():
         protein = float(data['protein'])
         fat = float(data['fat'])
         carbs = float(data['carbs'])
-        calories = DailyGoal.calculate_calories(protein, fat, carbs)
+        calories = calculate_calories(protein, fat, carbs)
 
         product = Product(
             user_id=current_user.id,
@@ -383,13 +498,13 @@ def api_add_product():
         db.session.add(product)
         db.session.commit()
 
-        return jsonify({
+        return json_response({
             'success': True,
             'product': product.to_dict()
         })
     except Exception as e:
         db.session.rollback()
-        return jsonify({'success': False, 'error': str(e)}), 500
+        return json_response({'success': False, 'error': str(e)}), 500
 
 
 # =====================================================
@@ -401,20 +516,22 @@ def api_add_product():
 def index():
     target_date = request.args.get('date')
     if target_date:
-        target_date = datetime.strptime(target_date, '%Y-%m-%d').date()
+        target_date = date.fromisoformat(target_date)
     else:
         target_date = date.today()
 
     return render_template('index.html',
                            target_date=target_date,
-                           meal_types=MEAL_TYPES,
                            today=date.today())
 
 
 @app.route('/products')
 @login_required
 def products():
-    all_products = Product.query.filter_by(user_id=current_user.id).order_by(Product.name).all()
+    # Только чтение: строки Row вместо ORM-объектов (без identity map и инструментирования)
+    all_products = db.session.execute(
+        select(*PRODUCT_LIST_COLUMNS).where(Product.user_id == current_user.id).order_by(Product.name)
+    ).all()
     return render_template('products.html', products=all_products)
 
 
@@ -423,20 +540,9 @@ def products():
 def add_product():
     if request.method == 'POST':
         name = request.form.get('name')
-        protein = float(request.form.get('protein', 0))
-        fat = float(request.form.get('fat', 0))
-        carbs = float(request.form.get('carbs', 0))
+        protein, fat, carbs = form_macros_per_100g()
 
-        serving_type = request.form.get('serving_type', '100')
-        custom_serving = float(request.form.get('custom_serving', 100))
-
-        if serving_type == 'custom' and custom_serving > 0:
-            multiplier = 100 / custom_serving
-            protein = round(protein * multiplier, 1)
-            fat = round(fat * multiplier, 1)
-            carbs = round(carbs * multiplier, 1)
-
-        calories = DailyGoal.calculate_calories(protein, fat, carbs)
+        calories = calculate_calories(protein, fat, carbs)
 
         product = Product(
             user_id=current_user.id,
@@ -461,24 +567,13 @@ def edit_product(product_id):
     product = Product.query.filter_by(id=product_id, user_id=current_user.id).first_or_404()
 
     if request.method == 'POST':
-        protein = float(request.form.get('protein', 0))
-        fat = float(request.form.get('fat', 0))
-        carbs = float(request.form.get('carbs', 0))
-
-        serving_type = request.form.get('serving_type', '100')
-        custom_serving = float(request.form.get('custom_serving', 100))
-
-        if serving_type == 'custom' and custom_serving > 0:
-            multiplier = 100 / custom_serving
-            protein = round(protein * multiplier, 1)
-            fat = round(fat * multiplier, 1)
-            carbs = round(carbs * multiplier, 1)
+        protein, fat, carbs = form_macros_per_100g()
 
         product.name = request.form.get('name')
         product.protein = protein
         product.fat = fat
         product.carbs = carbs
-        product.calories = DailyGoal.calculate_calories(protein, fat, carbs)
+        product.calories = calculate_calories(protein, fat, carbs)
 
         db.session.commit()
         flash('Продукт обновлен!', 'success')
@@ -504,7 +599,8 @@ def delete_product(product_id):
 @app.route('/recipes')
 @login_required
 def recipes():
-    all_recipes = Recipe.query.filter_by(user_id=current_user.id).order_by(Recipe.created_at.desc()).all()
+    all_recipes = Recipe.query.options(*list_options(RECIPE_INGREDIENTS_LOADER)).filter_by(
+        user_id=current_user.id).order_by(Recipe.created_at.desc()).all()
     return render_template('recipes.html', recipes=all_recipes)
 
 
@@ -519,49 +615,39 @@ def add_recipe():
             flash('Введите название рецепта', 'error')
             return redirect(url_for('add_recipe'))
 
-        recipe = Recipe(user_id=current_user.id, name=name, description=description)
-        db.session.add(recipe)
-        db.session.flush()
-
-        product_ids = request.form.getlist('product_id[]')
-        weights = request.form.getlist('weight[]')
-
-        if not product_ids or not any(product_ids):
+        if not any(request.form.getlist('product_id[]')):
             flash('Добавьте хотя бы один ингредиент', 'error')
-            db.session.rollback()
             return redirect(url_for('add_recipe'))
 
-        for product_id, weight in zip(product_ids, weights):
-            if product_id and weight:
-                ingredient = RecipeIngredient(
-                    recipe_id=recipe.id,
-                    product_id=int(product_id),
-                    weight=float(weight)
-                )
-                db.session.add(ingredient)
+        ingredients = form_recipe_ingredients()
 
-        db.session.flush()
-
-        nutrition = recipe.nutrition_per_100g
+        # Питательность считается по данным в памяти, без ленивых загрузок после flush()
+        total_weight, total = aggregate_nutrition(ingredients)
+        nutrition = nutrition_per_100g(total, total_weight)
         product = Product(
             user_id=current_user.id,
             name=name,
-            calories=nutrition['calories'],
-            protein=nutrition['protein'],
-            fat=nutrition['fat'],
-            carbs=nutrition['carbs'],
+            calories=nutrition.calories,
+            protein=nutrition.protein,
+            fat=nutrition.fat,
+            carbs=nutrition.carbs,
             is_recipe=True
         )
-        db.session.add(product)
+        recipe = Recipe(user_id=current_user.id, name=name, description=description, product=product)
+        db.session.add(recipe)
         db.session.flush()
 
-        recipe.product_id = product.id
+        if ingredients:
+            db.session.execute(insert(RecipeIngredient), [
+                {'recipe_id': recipe.id, 'product_id': ing_product.id, 'weight': weight}
+                for ing_product, weight in ingredients
+            ])
         db.session.commit()
 
         flash(f'Рецепт "{name}" создан!', 'success')
         return redirect(url_for('recipes'))
 
-    products_list = Product.query.filter_by(user_id=current_user.id, is_recipe=False).order_by(Product.name).all()
+    products_list = ingredient_choices(current_user.id)
     return render_template('add_recipe.html', products=products_list)
 
 
@@ -588,35 +674,30 @@ def edit_recipe(recipe_id):
         recipe.name = name
         recipe.description = description
 
-        RecipeIngredient.query.filter_by(recipe_id=recipe.id).delete()
-
-        product_ids = request.form.getlist('product_id[]')
-        weights = request.form.getlist('weight[]')
+        ingredients = form_recipe_ingredients()
 
-        for product_id, weight in zip(product_ids, weights):
-            if product_id and weight:
-                ingredient = RecipeIngredient(
-                    recipe_id=recipe.id,
-                    product_id=int(product_id),
-                    weight=float(weight)
-                )
-                db.session.add(ingredient)
-
-        db.session.flush()
+        db.session.execute(delete(RecipeIngredient).where(RecipeIngredient.recipe_id == recipe.id))
+        if ingredients:
+            db.session.execute(insert(RecipeIngredient), [
+                {'recipe_id': recipe.id, 'product_id': ing_product.id, 'weight': weight}
+                for ing_product, weight in ingredients
+            ])
 
         if recipe.product:
-            nutrition = recipe.nutrition_per_100g
+            # Считаем по уже загруженным продуктам, без повторной загрузки ингредиентов
+            total_weight, total = aggregate_nutrition(ingredients)
+            nutrition = nutrition_per_100g(total, total_weight)
             recipe.product.name = name
-            recipe.product.calories = nutrition['calories']
-            recipe.product.protein = nutrition['protein']
-            recipe.product.fat = nutrition['fat']
-            recipe.product.carbs = nutrition['carbs']
+            recipe.product.calories = nutrition.calories
+            recipe.product.protein = nutrition.protein
+            recipe.product.fat = nutrition.fat
+            recipe.product.carbs = nutrition.carbs
 
         db.session.commit()
         flash('Рецепт обновлен!', 'success')
         return redirect(url_for('recipes'))
 
-    products_list = Product.query.filter_by(user_id=current_user.id, is_recipe=False).order_by(Product.name).all()
+    products_list = ingredient_choices(current_user.id)
     return render_template('add_recipe.html', recipe=recipe, products=products_list, edit=True)
 
 
@@ -641,32 +722,30 @@ def delete_recipe(recipe_id):
 def daily_summary():
     target_date = request.args.get('date')
     if target_date:
-        target_date = datetime.strptime(target_date, '%Y-%m-%d').date()
+        target_date = date.fromisoformat(target_date)
     else:
         target_date = date.today()
 
-    return render_template('daily_summary.html',
-                           target_date=target_date,
-                           meal_types=MEAL_TYPES)
+    return render_template('daily_summary.html', target_date=target_date)
 
 
 @app.route('/settings', methods=['GET', 'POST'])
 @login_required
 def settings():
-    goals = DailyGoal.get_goals(current_user.id)
+    goals = goals_for(current_user.id)
 
     if request.method == 'POST':
-        weight = float(request.form.get('weight', current_user.weight))
+        weight = form_float('weight', current_user.weight)
         current_user.weight = weight
 
-        protein = float(request.form.get('protein', 50))
-        fat = float(request.form.get('fat', 65))
-        carbs = float(request.form.get('carbs', 300))
+        protein = form_float('protein', 50)
+        fat = form_float('fat', 65)
+        carbs = form_float('carbs', 300)
 
         goals.protein = protein
         goals.fat = fat
         goals.carbs = carbs
-        goals.calories = DailyGoal.calculate_calories(protein, fat, carbs)
+        goals.calories = calculate_calories(protein, fat, carbs)
 
         db.session.commit()
         flash(f'Настройки сохранены! Норма: {int(goals.calories)} ккал/день', 'success')
@@ -707,51 +786,127 @@ def change_password():
 # HELPER FUNCTIONS
 # =====================================================
 
-def create_default_products(user_id):
-    """Create default products for a new user"""
-    default_products = [
-        ('Куриная грудка', 31, 3.6, 0),
-        ('Рис белый', 2.7, 0.3, 28),
-        ('Яйцо куриное', 13, 11, 1.1),
-        ('Овсянка', 2.4, 1.4, 12),
-        ('Банан', 1.1, 0.3, 23),
-        ('Творог 5%', 17, 5, 1.8),
-        ('Гречка', 4.2, 1.1, 21),
-        ('Молоко 2.5%', 2.8, 2.5, 4.7),
-        ('Хлеб белый', 9, 3.2, 49),
-        ('Яблоко', 0.3, 0.2, 14),
-        ('Говядина', 26, 15, 0),
-        ('Лосось', 20, 13, 0),
-        ('Картофель', 2, 0.1, 17),
-        ('Макароны', 5, 1.1, 25),
-        ('Сыр твердый', 25, 33, 1.3),
+DEFAULT_PRODUCTS = (
+    ('Куриная грудка', 31, 3.6, 0),
+    ('Рис белый', 2.7, 0.3, 28),
+    ('Яйцо куриное', 13, 11, 1.1),
+    ('Овсянка', 2.4, 1.4, 12),
+    ('Банан', 1.1, 0.3, 23),
+    ('Творог 5%', 17, 5, 1.8),
+    ('Гречка', 4.2, 1.1, 21),
+    ('Молоко 2.5%', 2.8, 2.5, 4.7),
+    ('Хлеб белый', 9, 3.2, 49),
+    ('Яблоко', 0.3, 0.2, 14),
+    ('Говядина', 26, 15, 0),
+    ('Лосось', 20, 13, 0),
+    ('Картофель', 2, 0.1, 17),
+    ('Макароны', 5, 1.1, 25),
+    ('Сыр твердый', 25, 33, 1.3),
+)
+
+# Строки для вставки считаются один раз при импорте, а не на каждую регистрацию
+DEFAULT_PRODUCT_ROWS = tuple(
+    {
+        'name': name,
+        'calories': calculate_calories(protein, fat, carbs),
+        'protein': protein,
+        'fat': fat,
+        'carbs': carbs
+    }
+    for name, protein, fat, carbs in DEFAULT_PRODUCTS
+)
+
+
+def goals_for(user_id):
+    """DailyGoal for user_id, loaded at most once per request"""
+    goals = g.get('daily_goals')
+    if goals is None or goals.user_id != user_id:
+        goals = g.daily_goals = DailyGoal.get_goals(user_id)
+    return goals
+
+
+def ingredient_choices(user_id):
+    """Non-recipe products for the recipe form as light dicts (one indexed Core SELECT per render)"""
+    return [row._asdict() for row in db.session.execute(
+        select(Product.id, Product.name, Product.calories, Product.protein, Product.fat, Product.carbs)
+        .where(Product.user_id == user_id, Product.is_recipe.is_(False))
+        .order_by(Product.name)
+    )]
+
+
+def form_recipe_ingredients():
+    """(product, weight) pairs from the recipe form; products are loaded with a single IN query"""
+    pairs = [
+        (int(product_id), float(weight))
+        for product_id, weight in zip(request.form.getlist('product_id[]'), request.form.getlist('weight[]'))
+        if product_id and weight
     ]
+    by_id = {p.id: p for p in Product.query.filter(
+        Product.user_id == current_user.id,
+        Product.id.in_({product_id for product_id, _ in pairs})
+    )}
+    return [(by_id[product_id], weight) for product_id, weight in pairs if product_id in by_id]
 
-    for name, protein, fat, carbs in default_products:
-        calories = DailyGoal.calculate_calories(protein, fat, carbs)
-        product = Product(
-            user_id=user_id,
-            name=name,
-            calories=calories,
-            protein=protein,
-            fat=fat,
-            carbs=carbs
-        )
-        db.session.add(product)
 
-    db.session.commit()
+def form_float(key, default):
+    """Read a numeric form field; missing or empty values fall back to default"""
+    value = request.form.get(key)
+    return float(value) if value else default
+
+
+def form_macros_per_100g():
+    """Read protein/fat/carbs from the product form, converted from a custom serving to 100g"""
+    form = request.form
+    protein = float(form.get('protein') or 0)
+    fat = float(form.get('fat') or 0)
+    carbs = float(form.get('carbs') or 0)
+
+    custom_serving = float(form.get('custom_serving') or 100)
+    if form.get('serving_type', '100') == 'custom' and custom_serving > 0:
+        multiplier = 100 / custom_serving
+        protein = round(protein * multiplier, 1)
+        fat = round(fat * multiplier, 1)
+        carbs = round(carbs * multiplier, 1)
+
+    return protein, fat, carbs
+
+
+def create_default_products(user_id):
+    """Create default products for a new user (committed by the caller)"""
+    db.session.execute(insert(Product), [dict(row, user_id=user_id) for row in DEFAULT_PRODUCT_ROWS])
 
 
 # =====================================================
 # INITIALIZE DATABASE
 # =====================================================
 
-with app.app_context():
+def upgrade_schema():
+    """Create missing tables, then indexes added after a table was created (create_all skips existing tables)"""
     db.create_all()
+    with db.engine.begin() as conn:
+        # Старый get-or-create целей мог создать дубликаты при гонке; оставляем самую раннюю запись,
+        # иначе уникальный ix_dailygoal_user не создастся
+        conn.execute(delete(DailyGoal).where(DailyGoal.id.not_in(
+            select(func.min(DailyGoal.id)).group_by(DailyGoal.user_id)
+        )))
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+
+@app.cli.command('init-db')
+def init_db():
+    """Create or upgrade database tables (run on each deployment: flask init-db)"""
+    upgrade_schema()
+    print('База данных инициализирована')
+
 
 if __name__ == '__main__':
     import sys
 
+    with app.app_context():
+        upgrade_schema()
+
     port = int(sys.argv[1]) if len(sys.argv) > 1 else 5001
     print(f"Starting server on http://localhost:{port}")
     app.run(debug=True, port=port, host='0.0.0.0')
\ No newline at end of file
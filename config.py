@@ -7,6 +7,9 @@ class Config:
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///meals.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    # Raise on implicit lazy loads in list endpoints (development only)
+    RAISELOAD_DEBUG = os.environ.get('RAISELOAD_DEBUG', '').lower() in ('1', 'true')
+
     # Daily recommended values (defaults)
     DAILY_CALORIES = 2000
     DAILY_PROTEIN = 50
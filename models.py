@@ -1,11 +1,89 @@
 # models.py
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime, date
+from functools import cached_property, lru_cache
+from types import MappingProxyType
+from typing import NamedTuple
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
+from sqlalchemy import event, inspect
+from sqlalchemy.dialects import postgresql, sqlite
 
 db = SQLAlchemy()
 
+# Диалекты с INSERT ... ON CONFLICT DO NOTHING
+UPSERT_INSERTS = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}
+
+
+@lru_cache(maxsize=None)
+def has_unique_goal_index(engine):
+    """ON CONFLICT (user_id) needs ix_dailygoal_user, which old databases get only from upgrade_schema()"""
+    return any(index['name'] == 'ix_dailygoal_user' for index in inspect(engine).get_indexes('daily_goal'))
+
+
+class Nutr(NamedTuple):
+    """Calories and macros of a portion; converted to a dict only at the JSON boundary"""
+    calories: float
+    protein: float
+    fat: float
+    carbs: float
+
+
+ZERO_NUTR = Nutr(0, 0, 0, 0)
+
+
+class ActivityMultipliers(NamedTuple):
+    """Grams of each macro per kg of body weight"""
+    protein: float
+    fat: float
+    carbs: float
+
+
+ACTIVITY_MULTIPLIERS = MappingProxyType({
+    'low': ActivityMultipliers(1.2, 0.8, 3),
+    'moderate': ActivityMultipliers(1.5, 1.0, 4),
+    'high': ActivityMultipliers(1.8, 1.0, 5),
+    'athlete': ActivityMultipliers(2.2, 1.2, 6)
+})
+
+
+def round_nutrition(nutr):
+    """Round a Nutr to 0.1 for display; done once, after all summing and scaling"""
+    return Nutr(round(nutr.calories, 1), round(nutr.protein, 1), round(nutr.fat, 1), round(nutr.carbs, 1))
+
+
+def calculate_calories(protein, fat, carbs):
+    """Calculate calories from macros: P*4 + F*9 + C*4"""
+    return round(protein * 4 + fat * 9 + carbs * 4, 1)
+
+
+def aggregate_nutrition(items):
+    """Total weight and unrounded summed nutrition of (product, weight) pairs, in a single pass over scalar locals"""
+    total_weight = 0
+    calories = protein = fat = carbs = 0.0
+    for product, weight in items:
+        total_weight += weight
+        cal_g, protein_g, fat_g, carbs_g = product.per_gram
+        calories += cal_g * weight
+        protein += protein_g * weight
+        fat += fat_g * weight
+        carbs += carbs_g * weight
+    return total_weight, Nutr(calories, protein, fat, carbs)
+
+
+def nutrition_per_100g(total, total_weight):
+    """Scale total nutrition of a dish weighing total_weight grams to 100g"""
+    if total_weight == 0:
+        return ZERO_NUTR
+
+    multiplier = 100 / total_weight
+    return round_nutrition(Nutr(
+        total.calories * multiplier,
+        total.protein * multiplier,
+        total.fat * multiplier,
+        total.carbs * multiplier
+    ))
+
 
 class User(UserMixin, db.Model):
     """User model for authentication"""
@@ -14,7 +92,7 @@ class User(UserMixin, db.Model):
     password_hash = db.Column(db.String(256), nullable=False)
     weight = db.Column(db.Float, default=70.0)  # Вес пользователя в кг
     is_setup_complete = db.Column(db.Boolean, default=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.deferred(db.Column(db.DateTime, default=datetime.utcnow))
 
     # Relationships
     products = db.relationship('Product', backref='user', lazy=True, cascade='all, delete-orphan')
@@ -50,7 +128,13 @@ class Product(db.Model):
     fat = db.Column(db.Float, nullable=False)
     carbs = db.Column(db.Float, nullable=False)
     is_recipe = db.Column(db.Boolean, default=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.deferred(db.Column(db.DateTime, default=datetime.utcnow))
+
+    __table_args__ = (
+        db.Index('ix_product_user_name', 'user_id', 'name'),
+    )
+
+    _per_g = None  # Кэш КБЖУ на 1 г, сбрасывается при изменении/перезагрузке строки
 
     def to_dict(self):
         return {
@@ -64,13 +148,29 @@ class Product(db.Model):
         }
 
     def get_nutrition_for_weight(self, weight):
-        multiplier = weight / 100
-        return {
-            'calories': round(self.calories * multiplier, 1),
-            'protein': round(self.protein * multiplier, 1),
-            'fat': round(self.fat * multiplier, 1),
-            'carbs': round(self.carbs * multiplier, 1)
-        }
+        return round_nutrition(self.get_nutrition_for_weight_raw(weight))
+
+    def get_nutrition_for_weight_raw(self, weight):
+        """Unrounded nutrition for accumulators; round only the final result"""
+        return Nutr(*(value * weight for value in self.per_gram))
+
+    @property
+    def per_gram(self):
+        """(calories, protein, fat, carbs) per gram, computed once per loaded row"""
+        if self._per_g is None:
+            self._per_g = (self.calories / 100, self.protein / 100, self.fat / 100, self.carbs / 100)
+        return self._per_g
+
+
+def reset_per_gram(target, *args):
+    if target is not None:  # при expire объект мог быть уже собран сборщиком мусора
+        target._per_g = None
+
+
+for attr in (Product.calories, Product.protein, Product.fat, Product.carbs):
+    event.listen(attr, 'set', reset_per_gram)
+event.listen(Product, 'expire', reset_per_gram)
+event.listen(Product, 'refresh', reset_per_gram)
 
 
 class Recipe(db.Model):
@@ -80,50 +180,57 @@ class Recipe(db.Model):
     name = db.Column(db.String(100), nullable=False)
     description = db.Column(db.Text, nullable=True)
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=True)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.deferred(db.Column(db.DateTime, default=datetime.utcnow))
 
-    ingredients = db.relationship('RecipeIngredient', backref='recipe', lazy=True, cascade='all, delete-orphan')
-    product = db.relationship('Product', backref='recipe_source', foreign_keys=[product_id])
+    ingredients = db.relationship('RecipeIngredient', backref='recipe', lazy='selectin', cascade='all, delete-orphan')
+    product = db.relationship('Product', backref=db.backref('recipe_source', lazy='raise_on_sql'),
+                              foreign_keys=[product_id])
+
+    __table_args__ = (
+        db.Index('ix_recipe_user', 'user_id'),
+    )
 
     def to_dict(self):
+        total_weight, total = self._totals
         return {
             'id': self.id,
             'name': self.name,
             'description': self.description,
             'product_id': self.product_id,
             'ingredients': [ing.to_dict() for ing in self.ingredients],
-            'total_weight': self.total_weight,
-            'total_nutrition': self.total_nutrition,
-            'nutrition_per_100g': self.nutrition_per_100g
+            'total_weight': total_weight,
+            'total_nutrition': round_nutrition(total)._asdict(),
+            'nutrition_per_100g': nutrition_per_100g(total, total_weight)._asdict()
         }
 
     @property
     def total_weight(self):
-        return sum(ing.weight for ing in self.ingredients)
+        return self._totals[0]
 
     @property
     def total_nutrition(self):
-        totals = {'calories': 0, 'protein': 0, 'fat': 0, 'carbs': 0}
-        for ing in self.ingredients:
-            nutrition = ing.product.get_nutrition_for_weight(ing.weight)
-            for key in totals:
-                totals[key] += nutrition[key]
-        return {k: round(v, 1) for k, v in totals.items()}
+        return round_nutrition(self._totals[1])
 
     @property
     def nutrition_per_100g(self):
-        total_weight = self.total_weight
-        if total_weight == 0:
-            return {'calories': 0, 'protein': 0, 'fat': 0, 'carbs': 0}
+        total_weight, total = self._totals
+        return nutrition_per_100g(total, total_weight)
 
-        total = self.total_nutrition
-        multiplier = 100 / total_weight
-        return {
-            'calories': round(total['calories'] * multiplier, 1),
-            'protein': round(total['protein'] * multiplier, 1),
-            'fat': round(total['fat'] * multiplier, 1),
-            'carbs': round(total['carbs'] * multiplier, 1)
-        }
+    @cached_property
+    def _totals(self):
+        """(total_weight, total_nutrition) from one pass over the ingredients, kept until they change"""
+        return aggregate_nutrition((ing.product, ing.weight) for ing in self.ingredients)
+
+
+def reset_recipe_totals(target, *args):
+    if target is not None:
+        target.__dict__.pop('_totals', None)
+
+
+event.listen(Recipe.ingredients, 'append', reset_recipe_totals)
+event.listen(Recipe.ingredients, 'remove', reset_recipe_totals)
+event.listen(Recipe, 'expire', reset_recipe_totals)
+event.listen(Recipe, 'refresh', reset_recipe_totals)
 
 
 class RecipeIngredient(db.Model):
@@ -133,15 +240,17 @@ class RecipeIngredient(db.Model):
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
     weight = db.Column(db.Float, nullable=False)
 
-    product = db.relationship('Product', backref='recipe_ingredients', foreign_keys=[product_id])
+    product = db.relationship('Product', backref=db.backref('recipe_ingredients', lazy='raise_on_sql'),
+                              foreign_keys=[product_id], lazy='joined', innerjoin=True)
 
     def to_dict(self):
+        product = self.product
         return {
             'id': self.id,
             'product_id': self.product_id,
-            'product_name': self.product.name if self.product else '',
+            'product_name': product.name,
             'weight': self.weight,
-            'nutrition': self.nutrition
+            'nutrition': product.get_nutrition_for_weight(self.weight)._asdict()
         }
 
     @property
@@ -157,20 +266,25 @@ class MealEntry(db.Model):
     meal_type = db.Column(db.String(20), nullable=False)
     weight = db.Column(db.Float, nullable=False)
     date = db.Column(db.Date, nullable=False, default=date.today)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.deferred(db.Column(db.DateTime, default=datetime.utcnow))
+
+    product = db.relationship('Product', backref=db.backref('entries', lazy='raise_on_sql'))
 
-    product = db.relationship('Product', backref=db.backref('entries', lazy=True))
+    __table_args__ = (
+        db.Index('ix_mealentry_user_date', 'user_id', 'date'),
+    )
 
     def to_dict(self):
+        product = self.product
         return {
             'id': self.id,
             'product_id': self.product_id,
-            'product_name': self.product.name if self.product else '',
-            'product_is_recipe': self.product.is_recipe if self.product else False,
+            'product_name': product.name,
+            'product_is_recipe': product.is_recipe,
             'meal_type': self.meal_type,
             'weight': self.weight,
             'date': self.date.isoformat(),
-            'nutrition': self.nutrition
+            'nutrition': product.get_nutrition_for_weight(self.weight)._asdict()
         }
 
     @property
@@ -187,6 +301,10 @@ class DailyGoal(db.Model):
     fat = db.Column(db.Float, default=65)
     carbs = db.Column(db.Float, default=300)
 
+    __table_args__ = (
+        db.Index('ix_dailygoal_user', 'user_id', unique=True),
+    )
+
     def to_dict(self):
         return {
             'calories': self.calories,
@@ -199,15 +317,20 @@ class DailyGoal(db.Model):
     def get_goals(cls, user_id):
         goal = cls.query.filter_by(user_id=user_id).first()
         if not goal:
-            goal = cls(user_id=user_id)
-            db.session.add(goal)
+            engine = db.session.get_bind()
+            upsert = UPSERT_INSERTS.get(engine.dialect.name) if has_unique_goal_index(engine) else None
+            if upsert is None:
+                db.session.add(cls(user_id=user_id))
+            else:
+                # Параллельный запрос мог уже создать цели - конфликт по user_id просто игнорируется
+                db.session.execute(
+                    upsert(cls).values(user_id=user_id).on_conflict_do_nothing(index_elements=['user_id'])
+                )
             db.session.commit()
+            goal = cls.query.filter_by(user_id=user_id).one()
         return goal
 
-    @staticmethod
-    def calculate_calories(protein, fat, carbs):
-        """Calculate calories from macros: P*4 + F*9 + C*4"""
-        return round((protein * 4) + (fat * 9) + (carbs * 4), 1)
+    calculate_calories = staticmethod(calculate_calories)
 
     @staticmethod
     def calculate_recommended(weight, activity_level='moderate'):
@@ -218,20 +341,12 @@ class DailyGoal(db.Model):
         # Белки: 1.5-2г на кг веса
         # Жиры: 0.8-1г на кг веса
         # Углеводы: остаток калорий
+        mult = ACTIVITY_MULTIPLIERS.get(activity_level) or ACTIVITY_MULTIPLIERS['moderate']
 
-        activity_multipliers = {
-            'low': {'protein': 1.2, 'fat': 0.8, 'carbs': 3},
-            'moderate': {'protein': 1.5, 'fat': 1.0, 'carbs': 4},
-            'high': {'protein': 1.8, 'fat': 1.0, 'carbs': 5},
-            'athlete': {'protein': 2.2, 'fat': 1.2, 'carbs': 6}
-        }
-
-        mult = activity_multipliers.get(activity_level, activity_multipliers['moderate'])
-
-        protein = round(weight * mult['protein'])
-        fat = round(weight * mult['fat'])
-        carbs = round(weight * mult['carbs'])
-        calories = DailyGoal.calculate_calories(protein, fat, carbs)
+        protein = round(weight * mult.protein)
+        fat = round(weight * mult.fat)
+        carbs = round(weight * mult.carbs)
+        calories = round(protein * 4 + fat * 9 + carbs * 4, 1)
 
         return {
             'protein': protein,
@@ -0,0 +1,80 @@
+# test_app.py
+import os
+from datetime import date
+
+# Конфигурация читается при импорте app: отдельная БД в памяти и raiseload во всех списках
+os.environ['DATABASE_URL'] = 'sqlite://'
+os.environ['RAISELOAD_DEBUG'] = '1'
+
+import pytest
+from sqlalchemy.exc import InvalidRequestError
+
+from app import app, create_default_products
+from models import db, User, Product, MealEntry, DailyGoal, Recipe, RecipeIngredient
+
+
+@pytest.fixture
+def client():
+    app.config['TESTING'] = True
+    with app.app_context():
+        db.create_all()
+
+        user = User(username='alice', weight=70, is_setup_complete=True)
+        user.set_password('secret')
+        db.session.add(user)
+        db.session.flush()
+        create_default_products(user.id)
+        db.session.add(DailyGoal(user_id=user.id))
+
+        products = Product.query.filter_by(user_id=user.id).order_by(Product.id).limit(2).all()
+        recipe_product = Product(user_id=user.id, name='Каша', calories=120, protein=4, fat=2, carbs=21,
+                                 is_recipe=True)
+        recipe = Recipe(user_id=user.id, name='Каша', product=recipe_product, ingredients=[
+            RecipeIngredient(product=product, weight=100) for product in products
+        ])
+        db.session.add(recipe)
+        db.session.add(MealEntry(user_id=user.id, product=products[0], meal_type='breakfast', weight=150,
+                                 date=date.today()))
+        db.session.add(MealEntry(user_id=user.id, product=recipe_product, meal_type='lunch', weight=250,
+                                 date=date.today()))
+        db.session.commit()
+
+    with app.test_client() as client:
+        client.post('/login', data={'username': 'alice', 'password': 'secret'})
+        yield client
+
+    with app.app_context():
+        db.drop_all()
+
+
+def test_list_endpoints_have_no_lazy_loads(client):
+    assert app.config['RAISELOAD_DEBUG']
+
+    response = client.get('/api/sync')
+    assert response.status_code == 200
+    data = response.get_json()['data']
+    assert len(data['recipes']) == 1
+    assert len(data['recipes'][0]['ingredients']) == 2
+    assert len(data['entries']) == 2
+
+    assert client.get('/recipes').status_code == 200
+    assert client.get('/products').status_code == 200
+
+
+def test_product_backrefs_raise_on_lazy_access(client):
+    with app.app_context():
+        product = Product.query.filter_by(is_recipe=False).order_by(Product.id).first()
+        for backref in ('entries', 'recipe_ingredients', 'recipe_source'):
+            with pytest.raises(InvalidRequestError):
+                getattr(product, backref)
+
+
+def test_delete_product_without_entries(client):
+    with app.app_context():
+        product_id = Product.query.filter_by(is_recipe=False).order_by(Product.id.desc()).first().id
+
+    response = client.post(f'/delete_product/{product_id}')
+    assert response.status_code == 302
+
+    with app.app_context():
+        assert db.session.get(Product, product_id) is None